@@ -18,21 +18,45 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from bisect import bisect_left
+from itertools import chain
 import math
 import sys
 from matplotlib import pyplot, colors
 import numpy as np
 from numpy import random
-from scipy import linalg, stats
+from scipy import linalg
+from scipy.spatial import cKDTree, Delaunay
 from . import generator, rotator
 from .index import Index2D, Index3D
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # plain Python fallback when numba is not available
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+try:
+    from shapely.geometry import MultiLineString, MultiPoint, Point
+    from shapely.ops import polygonize, unary_union
+    HAVE_SHAPELY = True
+except ImportError:
+    HAVE_SHAPELY = False
+
 
 if sys.version_info[0] >= 3:
     xrange = range
 
 
+# fastmath flags without "nnan"/"ninf": the kernels below rely on np.inf
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(cache=True, fastmath=FASTMATH)
 def min_z_separation(elems,ref_elem,grid_res_sqr):
     """Displacement needed to connect elements.
 
@@ -45,18 +69,282 @@ def min_z_separation(elems,ref_elem,grid_res_sqr):
         grid_res_sqr: The squared size of each element.
 
     Returns:
-        The displacement.
+        The displacement, or np.inf if no element is close enough in the
+        (x,y) plane.
+    """
+    min_z = np.inf
+    for k in range(elems.shape[0]):
+        dx = elems[k,0]-ref_elem[0]
+        dy = elems[k,1]-ref_elem[1]
+        x_sep_sqr = dx*dx + dy*dy
+        if x_sep_sqr >= grid_res_sqr:
+            continue
+        z_sep = elems[k,2] - ref_elem[2] - np.sqrt(grid_res_sqr-x_sep_sqr)
+        if z_sep < min_z:
+            min_z = z_sep
+    return min_z
+
+
+# Serial: after max_height_per_bin the inputs are only tens to hundreds of
+# rows, too few to pay for the thread dispatch.
+@njit(cache=True, fastmath=FASTMATH)
+def min_z_separation_all(elems, ref_elems, grid_res_sqr):
+    """The smallest min_z_separation over a set of reference elements.
+
+    Args:
+        elems: The Nx3 array of element coordinates.
+        ref_elems: The Mx3 array of reference element coordinates.
+        grid_res_sqr: The squared size of each element.
+
+    Returns:
+        The displacement, or np.inf if no pair of elements is close enough
+        in the (x,y) plane.
     """
-    elems = np.array(list(elems))
-    if not len(elems):  
-        return np.inf
-    x_sep_sqr = ((elems[:,:2]-ref_elem[:2])**2).sum(1)
-    match_possible = (x_sep_sqr < grid_res_sqr)
-    z_sep = np.empty(match_possible.shape)
-    z_sep[match_possible] = elems[match_possible,2] - ref_elem[2] - \
-        np.sqrt(grid_res_sqr-x_sep_sqr[match_possible])
-    z_sep[~match_possible] = np.inf            
-    return z_sep.min()
+    min_z = np.inf
+    for i in range(ref_elems.shape[0]):
+        z_sep = min_z_separation(elems, ref_elems[i], grid_res_sqr)
+        if z_sep < min_z:
+            min_z = z_sep
+    return min_z
+
+
+def find_min_distance(pc1, pc2, epsilon, max_block_size=2**20):
+    """Displacement needed to connect two sets of elements.
+
+    Compute the displacement in the z direction required to move the
+    elements pc2 just below the elements pc1.
+
+    Args:
+        pc1: The Nx3 array of element coordinates of the upper particle.
+        pc2: The Mx3 array of element coordinates of the lower particle.
+        epsilon: The size of each element.
+        max_block_size: Without numba, the all-pairs search is done with 
+            NumPy on blocks of pc2 with at most this many pairs at a time.
+
+    Returns:
+        The displacement, or np.inf if the elements cannot be connected.
+    """
+    epsilon_sqr = epsilon**2
+    if HAVE_NUMBA:
+        return min_z_separation_all(
+            np.ascontiguousarray(pc1, dtype=np.float64),
+            np.ascontiguousarray(pc2, dtype=np.float64), epsilon_sqr)
+
+    min_z_sep = np.inf
+    if not (len(pc1) and len(pc2)):
+        return min_z_sep
+    block = max(max_block_size//len(pc1), 1)
+    for k in xrange(0, len(pc2), block):
+        pc2_block = pc2[k:k+block]
+        dx = pc2_block[:,0,None] - pc1[None,:,0]
+        dy = pc2_block[:,1,None] - pc1[None,:,1]
+        d_sqr = dx*dx + dy*dy
+        z_sep = np.where(d_sqr < epsilon_sqr,
+            pc1[None,:,2] - pc2_block[:,2,None] - 
+                np.sqrt(np.maximum(epsilon_sqr-d_sqr, 0)),
+            np.inf)
+        min_z_sep = min(min_z_sep, z_sep.min())
+    return min_z_sep
+
+
+# Serial although it runs over the whole aggregate: the loop is memory
+# bound and takes only about a tenth of pen_depth_intersection_mask, so
+# threads would save little, and starting the numba thread pool makes
+# later fork-based multiprocessing hang.
+@njit(cache=True, fastmath=FASTMATH)
+def _distance_to_point(X, p):
+    d = np.empty(X.shape[0])
+    for i in range(X.shape[0]):
+        dx = X[i,0]-p[0]
+        dy = X[i,1]-p[1]
+        dz = X[i,2]-p[2]
+        d[i] = np.sqrt(dx*dx + dy*dy + dz*dz)
+    return d
+
+
+def distance_to_point(X, p, tile_size=8192):
+    """Euclidean distance of each row of the (N,3) array X from p.
+
+    Without numba, X is processed in tiles of tile_size rows so that
+    the temporary arrays stay in the cache.
+    """
+    if HAVE_NUMBA:
+        return _distance_to_point(np.ascontiguousarray(X, dtype=np.float64),
+            np.asarray(p, dtype=np.float64))
+
+    d = np.empty(X.shape[0])
+    for i in xrange(0, X.shape[0], tile_size):
+        tile = slice(i, i+tile_size)
+        dX = X[tile] - p
+        np.einsum('ij,ij->i', dX, dX, out=d[tile])
+    return np.sqrt(d, out=d)
+
+
+def alpha_shape(points, alpha):
+    """The alpha shape of a set of 2D points.
+
+    The shape is the union of the Delaunay triangles with a circumradius
+    smaller than 1/alpha, with any holes filled. This gives the same
+    shape as the alphashape package (https://pypi.org/project/alphashape/),
+    except that triangles with a circumradius of exactly 1/alpha are
+    consistently left out.
+
+    Args:
+        points: (N,2) array of point coordinates.
+        alpha: The alpha parameter.
+
+    Returns:
+        The alpha shape as a Shapely geometry.
+    """
+    if not HAVE_SHAPELY:
+        raise ImportError("Shapely is needed for computing alpha shapes.")
+
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 4:
+        return MultiPoint(points).convex_hull
+
+    tri = Delaunay(points)
+    (a, b, c) = (points[tri.simplices[:,k]] for k in range(3))
+    # squared circumradius R**2 = la**2*lb**2*lc**2/(2*cross)**2, where 
+    # cross is twice the triangle area; this is exact for pixel coordinates
+    la_sqr = ((b-c)**2).sum(1)
+    lb_sqr = ((a-c)**2).sum(1)
+    lc_sqr = ((a-b)**2).sum(1)
+    cross = (b[:,0]-a[:,0])*(c[:,1]-a[:,1]) - (b[:,1]-a[:,1])*(c[:,0]-a[:,0])
+    keep = (cross != 0) & \
+        (la_sqr*lb_sqr*lc_sqr*alpha**2 < 4*cross**2)
+
+    # the perimeter consists of the edges belonging to only one triangle
+    simplices = tri.simplices[keep]
+    edges = np.vstack((simplices[:,[0,1]], simplices[:,[1,2]], 
+        simplices[:,[0,2]]))
+    edges.sort(axis=1)
+    (edges, count) = np.unique(edges, axis=0, return_counts=True)
+    perimeter = MultiLineString(list(points[edges[count==1]]))
+
+    # polygonizing the perimeter also fills any holes in the shape
+    return unary_union(list(polygonize(perimeter)))
+
+
+@njit(cache=True)
+def _eigenvector_0(A, l):
+    # unit eigenvector of the symmetric A for an eigenvalue l of
+    # multiplicity 1, from the cross products of the rows of A-lI
+    r0 = np.array([A[0,0]-l, A[0,1], A[0,2]])
+    r1 = np.array([A[0,1], A[1,1]-l, A[1,2]])
+    r2 = np.array([A[0,2], A[1,2], A[2,2]-l])
+    best = np.array([1.0, 0.0, 0.0])
+    best_norm_sqr = 0.0
+    for (u, w) in ((r0, r1), (r0, r2), (r1, r2)):
+        c = np.cross(u, w)
+        c_norm_sqr = (c**2).sum()
+        if c_norm_sqr > best_norm_sqr:
+            best = c
+            best_norm_sqr = c_norm_sqr
+    if best_norm_sqr > 0:
+        best = best/np.sqrt(best_norm_sqr)
+    return best
+
+
+@njit(cache=True)
+def _eigenvector_1(A, v0, l):
+    # unit eigenvector of the symmetric A for the eigenvalue l, orthogonal
+    # to the eigenvector v0, solved in the plane orthogonal to v0
+    if abs(v0[0]) > abs(v0[1]):
+        u = np.array([-v0[2], 0.0, v0[0]]) / np.sqrt(v0[0]**2 + v0[2]**2)
+    else:
+        u = np.array([0.0, v0[2], -v0[1]]) / np.sqrt(v0[1]**2 + v0[2]**2)
+    v = np.cross(v0, u)
+    Au = A.dot(u)
+    Av = A.dot(v)
+    m00 = u.dot(Au) - l
+    m01 = u.dot(Av)
+    m11 = v.dot(Av) - l
+    if abs(m00) >= abs(m11):
+        if max(abs(m00), abs(m01)) == 0:
+            return u
+        if abs(m00) >= abs(m01):
+            m01 /= m00
+            m00 = 1.0/np.sqrt(1.0+m01*m01)
+            m01 *= m00
+        else:
+            m00 /= m01
+            m01 = 1.0/np.sqrt(1.0+m00*m00)
+            m00 *= m01
+        return m01*u - m00*v
+    else:
+        if max(abs(m11), abs(m01)) == 0:
+            return u
+        if abs(m11) >= abs(m01):
+            m01 /= m11
+            m11 = 1.0/np.sqrt(1.0+m01*m01)
+            m01 *= m11
+        else:
+            m11 /= m01
+            m01 = 1.0/np.sqrt(1.0+m11*m11)
+            m11 *= m01
+        return m11*u - m01*v
+
+
+@njit(cache=True)
+def eigh3x3(A):
+    """Eigenvalues and eigenvectors of a symmetric 3x3 matrix.
+
+    Uses the closed-form solution of the characteristic polynomial for
+    the eigenvalues, and the robust construction of D. Eberly ("A Robust 
+    Eigensolver for 3x3 Symmetric Matrices") for the eigenvectors.
+
+    Args:
+        A: The symmetric (3,3) matrix.
+
+    Returns:
+        Tuple (l, v) like np.linalg.eigh: the eigenvalues in ascending 
+        order and the corresponding unit eigenvectors as the columns of v.
+    """
+    l = np.zeros(3)
+    v = np.eye(3)
+    scale = np.abs(A).max()
+    if scale == 0:
+        return (l, v)
+    A = A/scale
+
+    q = (A[0,0]+A[1,1]+A[2,2])/3.0
+    off_sqr = A[0,1]**2 + A[0,2]**2 + A[1,2]**2
+    p = np.sqrt(((A[0,0]-q)**2 + (A[1,1]-q)**2 + (A[2,2]-q)**2 + 
+        2*off_sqr)/6.0)
+    if p == 0:
+        # multiple of the identity matrix
+        l[:] = q*scale
+        return (l, v)
+
+    B = (A-q*np.eye(3))/p
+    half_det = 0.5*(B[0,0]*(B[1,1]*B[2,2]-B[1,2]*B[1,2]) - 
+        B[0,1]*(B[0,1]*B[2,2]-B[1,2]*B[0,2]) + 
+        B[0,2]*(B[0,1]*B[1,2]-B[1,1]*B[0,2]))
+    half_det = min(max(half_det, -1.0), 1.0)
+    phi = np.arccos(half_det)/3.0
+    beta2 = 2*np.cos(phi)
+    beta0 = 2*np.cos(phi + 2*np.pi/3)
+    beta1 = -(beta0+beta2)
+    l[0] = q + p*beta0
+    l[1] = q + p*beta1
+    l[2] = q + p*beta2
+
+    # start from the eigenvalue that is best separated from the others
+    if half_det >= 0:
+        v2 = _eigenvector_0(A, l[2])
+        v1 = _eigenvector_1(A, v2, l[1])
+        v0 = np.cross(v1, v2)
+    else:
+        v0 = _eigenvector_0(A, l[0])
+        v1 = _eigenvector_1(A, v0, l[1])
+        v2 = np.cross(v0, v1)
+    v[:,0] = v0
+    v[:,1] = v1
+    v[:,2] = v2
+
+    return (l*scale, v)
+
 
 def get_proj_area_from_alphashape(proj_grid, alpha=0.4):
     """
@@ -69,22 +357,25 @@ def get_proj_area_from_alphashape(proj_grid, alpha=0.4):
         alpha shape: see https://pypi.org/project/alphashape/e
 
     """
-    import alphashape
-    from shapely.geometry import Point, Polygon
-    
     coord = np.where(proj_grid>0) #get coordinates of ice pixel
  
-    alpha_shape = alphashape.alphashape(np.column_stack((coord[0],coord[1])),alpha) #get alpha shape
+    shape = alpha_shape(np.column_stack((coord[0],coord[1])),alpha) #get alpha shape
 
     if proj_grid.shape[0]*proj_grid.shape[1]>10000:
         #many pixels: get area from alpha-shape polygon (computational cheaper than counting pixel and relatively accurate for large aggregates<5% deviation)
-        area = alpha_shape.area 
+        area = shape.area 
     else: #few pixels: pixel-wise evaluation of area
-        area=0
-        for i in range(0,proj_grid.shape[0]):
-            for j in range(0,proj_grid.shape[1]):
-                if Point(i,j).intersects(alpha_shape):
-                    area+=1
+        (i, j) = np.indices(proj_grid.shape)
+        (i, j) = (i.ravel(), j.ravel())
+        try:
+            from shapely import intersects_xy # Shapely >= 2.0
+            inside = intersects_xy(shape, i, j)
+        except ImportError:
+            from shapely.prepared import prep
+            shape_prep = prep(shape)
+            inside = np.array([shape_prep.intersects(Point(p)) 
+                for p in zip(i, j)], dtype=bool)
+        area = int(inside.sum())
 
     return area
 
@@ -102,6 +393,10 @@ class Aggregate(object):
             (integer, default 0).
     """
 
+    # remove_elements uses a k-d tree when removing at least this many
+    # elements; below that, sweeping over X once per element is faster
+    KDTREE_MIN_REMOVED = 16
+
     def __init__(self, generator, ident=0):
         self._generator = generator
         self.grid_res = generator.grid_res            
@@ -113,6 +408,85 @@ class Aggregate(object):
         self.mono_type = generator.crystal
 
 
+    @property
+    def X(self):
+        """The (N,3) array of element coordinates.
+
+        The coordinates are stored internally as separate contiguous
+        float32 arrays for each dimension; this array is assembled from them
+        when needed and is read-only. To modify the coordinates, assign a 
+        new array to X.
+        """
+        if self._X is None:
+            self._X = np.column_stack((self._x, self._y, self._z))
+            self._X.flags.writeable = False
+        return self._X
+
+
+    @X.setter
+    def X(self, X):
+        X = np.asarray(X, dtype=np.float32).reshape(-1,3)
+        # growable (3,capacity) buffer, see add_elements
+        self._X_buf = np.array(X.T, order='C')
+        self._n = X.shape[0]
+        self._update_views()
+        self._XtX = None
+        self._extent_current = False
+
+
+    @property
+    def ident(self):
+        """The (N,) array with the numerical identifiers of the elements."""
+        return self._ident_buf[:self._n]
+
+
+    @ident.setter
+    def ident(self, ident):
+        ident = np.asarray(ident)
+        if ident.shape != (self._n,):
+            raise ValueError("ident must have one value for each element.")
+        # same capacity as the coordinate buffer, see add_elements
+        self._ident_buf = np.empty(self._X_buf.shape[1], dtype=np.int32)
+        self._ident_buf[:self._n] = ident
+
+
+    def _random_generator(self):
+        # The random number generator for this aggregate. It is seeded from
+        # the global NumPy random state so that np.random.seed still gives
+        # reproducible results.
+        if getattr(self, "_rng", None) is None:
+            self._rng = np.random.default_rng(np.random.randint(2**31))
+        return self._rng
+
+
+    def _update_views(self):
+        (self._x, self._y, self._z) = self._X_buf[:,:self._n]
+        self._X = None
+        self._pa = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ["_x", "_y", "_z", "_X", "_pa"]:
+            del state[k]
+        # drop the unused capacity of the buffers
+        state["_X_buf"] = self._X_buf[:,:self._n].copy()
+        state["_ident_buf"] = self._ident_buf[:self._n].copy()
+        return state
+
+
+    def __setstate__(self, state):
+        # aggregates pickled before the coordinates were split by dimension
+        X = state.pop("X", None)
+        ident = state.pop("ident", None)
+        self.__dict__.update(state)
+        if X is not None:
+            self.X = X
+            self.ident = ident
+        else:
+            self._update_views()
+
+
     def update_extent(self):
         """Updates the particle size information.
 
@@ -122,14 +496,13 @@ class Aggregate(object):
         are finished.
         """
 
-        x = self.X[:,0]
-        y = self.X[:,1]
-        z = self.X[:,2]
+        (x, y, z) = (self._x, self._y, self._z)
         if len(x) != 0:
             self.extent = [[x.min(), x.max()], [y.min(), y.max()], 
                 [z.min(), z.max()]]
         else:
             self.extent = [[0.,0.],[0.,0.],[0.,0.]]
+        self._extent_current = True
 
 
     def project_on_dim(self, dim=2, direction=None):
@@ -157,36 +530,33 @@ class Aggregate(object):
             dimensions (x,y) of the aggregate (in that order).
         """
         if direction is not None:
-            dim = 0
+            # project the rotated coordinates; dim is taken to be 0 
             (alpha, beta) = direction
             R = rotator.Rotator.rotation_matrix(alpha, beta, 0)
-            self.X = self.X.dot(R)
-            self.update_extent()
-
-        try:
+            Xr = self.X.dot(R[:,1:])
+            (u, v) = (Xr[:,0], Xr[:,1])
+            (u0, v0) = (u.min(), v.min())
+        else:
             ext = self.extent
             if dim == 0:
-                xp = (self.X[:,1]-ext[1][0]) / self.grid_res
-                yp = (self.X[:,2]-ext[2][0]) / self.grid_res
+                (u, v, u0, v0) = (self._y, self._z, ext[1][0], ext[2][0])
             elif dim == 1:
-                xp = (self.X[:,0]-ext[0][0]) / self.grid_res
-                yp = (self.X[:,2]-ext[2][0]) / self.grid_res
+                (u, v, u0, v0) = (self._x, self._z, ext[0][0], ext[2][0])
             elif dim == 2:
-                xp = (self.X[:,0]-ext[0][0]) / self.grid_res
-                yp = (self.X[:,1]-ext[1][0]) / self.grid_res
+                (u, v, u0, v0) = (self._x, self._y, ext[0][0], ext[1][0])
             else:
                 raise AttributeError("Argument dim must be 0<=dim<=2.")
 
-            x_max = int(round(xp.max()))
-            y_max = int(round(yp.max()))
+        xp = (u-u0) / self.grid_res
+        yp = (v-v0) / self.grid_res
 
-            proj_grid = np.zeros((x_max+1,y_max+1), dtype=np.uint8)
-            proj_grid[xp.round().astype(int), yp.round().astype(int)] = 1
+        xi = np.rint(xp).astype(np.int64)
+        yi = np.rint(yp).astype(np.int64)
+        shape = (int(xi.max())+1, int(yi.max())+1)
 
-        finally:
-            if direction is not None:
-                self.X = self.X.dot(R.T)
-                self.update_extent()
+        # occupancy of each pixel from a count over the flattened indices
+        counts = np.bincount(xi*shape[1]+yi, minlength=shape[0]*shape[1])
+        proj_grid = (counts > 0).astype(np.uint8).reshape(shape)
 
         return proj_grid
 
@@ -248,13 +618,9 @@ class Aggregate(object):
 
         proj_grid = self.project_on_dim(dim=dim, direction=direction)
 
-        x_proj = proj_grid.any(axis=0)
-        y_proj = proj_grid.any(axis=1)
-        x0 = np.arange(len(x_proj))[x_proj][0]
-        x1 = np.arange(len(x_proj))[x_proj][-1]
-        y0 = np.arange(len(y_proj))[y_proj][0]
-        y1 = np.arange(len(y_proj))[y_proj][-1]
-        return float(y1-y0+1)/float(x1-x0+1)
+        x_ind = np.flatnonzero(proj_grid.any(axis=0))
+        y_ind = np.flatnonzero(proj_grid.any(axis=1))
+        return float(y_ind[-1]-y_ind[0]+1)/float(x_ind[-1]-x_ind[0]+1)
 
     def aspect_ratio(self):
         #calculate aspect ratio from principal_axes
@@ -280,28 +646,44 @@ class Aggregate(object):
             that axis.
         """
 
-        cov = self.X.T.dot(self.X)/self.X.shape[0]
-        # account for element size (this also regularizes the matrix)
-        cov += np.diag(np.full(3,self.grid_res**2/12.))
-        try:
-            (l,v) = np.linalg.eigh(cov)
-        except np.linalg.LinAlgError:
-            # In case the eigenvalue computation failed (e.g. singular cov)
-            v = np.zeros((3,3))
-            l = np.zeros(3)
-        return (v*np.sqrt(l))[:,::-1] # return in descending order
+        (v, l) = self._principal_axes_eig()
+        return v*np.sqrt(l)
+
+
+    def _principal_axes_eig(self):
+        # Unit principal axes (as columns) and the variances along them,
+        # in descending order. Cached until the coordinates change.
+        if self._pa is None:
+            cov = self._second_moment()/self._n
+            # account for element size (this also regularizes the matrix)
+            cov += np.diag(np.full(3,self.grid_res**2/12.))
+            (l,v) = eigh3x3(cov)
+            self._pa = (v[:,::-1], l[::-1])
+        return self._pa
+
+
+    def _second_moment(self):
+        # The (3,3) matrix X.T.dot(X); kept up to date by add_elements
+        # and update_coordinates, and recomputed after other changes.
+        if self._XtX is None:
+            # accumulate in float64 like the incremental updates
+            Xs = self._X_buf[:,:self._n].astype(np.float64)
+            self._XtX = Xs.dot(Xs.T)
+        return self._XtX
 
                   
     def pen_depth_intersection_mask(self, Xp, pen_depth, pen_depth_by_mass_fraction, verbose=False):
-        if pen_depth_by_mass_fraction >= 100: return np.ones(len(Xp)).astype(np.bool)
-        center = np.mean(Xp, axis=0)
-        distance2center = np.linalg.norm(Xp - center, axis=1)
+        if pen_depth_by_mass_fraction >= 100: return np.ones(len(Xp), dtype=bool)
+        center = Xp.mean(axis=0, dtype=np.float64)
+        distance2center = distance_to_point(Xp, center)
         #distance_limit = np.percentile(distance2center, pen_depth_by_mass_fraction) # gave unreliable/unreproducible results
-        distance_limit = np.sort(distance2center)[int(len(distance2center)*pen_depth_by_mass_fraction/100)]
-        mask_mf = distance2center <= distance_limit
-        mask_pd = distance2center <= (distance2center.max() - pen_depth)
-        mask = mask_mf | mask_pd
+        k = int(len(distance2center)*pen_depth_by_mass_fraction/100)
+        distance_limit = np.partition(distance2center, k)[k]
+        mask = distance2center <= max(distance_limit,
+            distance2center.max() - pen_depth)
         if verbose:
+            mask_mf = distance2center <= distance_limit
+            mask_pd = distance2center <= (distance2center.max() - pen_depth)
             print(f"mf={sum(mask_mf)/len(mask)*100:.1f}% pd={sum(mask_pd)/len(mask)*100:.1f}% mask={sum(mask)/len(mask)*100:.1f}%")
         return mask
 
@@ -356,11 +738,30 @@ class Aggregate(object):
         y0 = (self.extent[1][0]-extent[1][1])
         y1 = (self.extent[1][1]-extent[1][0])        
 
+        # elements from this particle that are allowed to connect; these
+        # do not change between the attempts below
+        imask_self = self.pen_depth_intersection_mask(self.X, pen_depth, 
+            pen_depth_by_mass_fraction)
+        X_self = self.X[imask_self,:]
+        # sorted x coordinates for finding the candidates in a given range
+        x_order_self = X_self[:,0].argsort(kind='stable')
+        x_sorted_self = X_self[x_order_self,0].astype(np.float64)
+        y_self = X_self[:,1].astype(np.float64)
+
+        # random locations in the x,y plane, drawn in batches
+        rng = self._random_generator()
+        batch_size = 64 if required else 1
+        shifts = iter(())
+
         site_found = False
         while not site_found:
             # randomize location in x,y plane
-            x_shift = x0+np.random.rand()*(x1-x0)
-            y_shift = y0+np.random.rand()*(y1-y0)
+            try:
+                (x_shift, y_shift) = next(shifts)
+            except StopIteration:
+                shifts = iter(rng.uniform(low=(x0,y0), high=(x1,y1), 
+                    size=(batch_size,2)))
+                (x_shift, y_shift) = next(shifts)
             xs = x+x_shift
             ys = y+y_shift
                     
@@ -382,13 +783,12 @@ class Aggregate(object):
                    break   
         
             # elements from this particle that are candidates for connection
-            imask = self.pen_depth_intersection_mask(self.X, pen_depth, pen_depth_by_mass_fraction)
-            X_filter = \
-                (self.X[:,0] >= overlapping_range[0]) & \
-                (self.X[:,0] < overlapping_range[1]) & \
-                (self.X[:,1] >= overlapping_range[2]) & \
-                (self.X[:,1] < overlapping_range[3])
-            overlapping_X = self.X[X_filter & imask,:]
+            (i0, i1) = x_sorted_self.searchsorted(overlapping_range[:2])
+            ind = x_order_self[i0:i1]
+            ind = ind[(y_self[ind] >= overlapping_range[2]) & 
+                (y_self[ind] < overlapping_range[3])]
+            ind.sort() # keep the original element order
+            overlapping_X = X_self[ind,:]
             if not len(overlapping_X):
                 if required:
                    continue
@@ -406,31 +806,18 @@ class Aggregate(object):
             
             # find displacement in z direction
 
-            def find_min_distance(pc1, pc2, epsilon):
-                epsilon_sqr = epsilon**2
-                elem_index2d = Index2D(elem_size=epsilon)
-                elem_index2d.insert(pc1[:,:2],pc1)
-                min_z_sep = np.inf
-                for elem in pc2:
-                    # find elements in this aggregate that are near the
-                    # currently tested element in the x,y plane
-                    candidates = np.array(list(elem_index2d.items_near(elem[:2], epsilon)))
-                    min_z_sep = min(min_z_sep, min_z_separation(candidates, elem, epsilon_sqr))
-                return min_z_sep
-
             import os
             MAXHEIGHTCOLLISION = float(os.environ.get('MAXHEIGHTCOLLISION', 1./np.sqrt(2)))
             if MAXHEIGHTCOLLISION > 0:
                 def max_height_per_bin(points, bin_size, inverse=False):
                     import numpy as np
                     """
-                    Use np.digitize to bin points into a 2D grid and get the max-z point in each bin.
+                    Bin points into a 2D grid and get the max-z point in each bin.
 
                     Parameters:
                         points: (N, 3) array of x, y, z
                         bin_size: scalar
-                        x_range: (min_x, max_x) (optional, computed from data if None)
-                        y_range: (min_y, max_y)
+                        inverse: if True, get the min-z point instead
 
                     Returns:
                         (M, 3) array of highest points per bin
@@ -440,30 +827,30 @@ class Aggregate(object):
                     z = points[:, 2]
                     if len(points)<1: return points
 
-                    # Set bin edges
-                    x_range = (x.min(), x.max())
-                    y_range = (y.min(), y.max())
-                    x_bins = np.arange(x_range[0], x_range[1] + bin_size, bin_size)
-                    y_bins = np.arange(y_range[0], y_range[1] + bin_size, bin_size)
-
-                    # Bin index starts at 1 (np.digitize behavior)
-                    x_idx = np.digitize(x, x_bins) - 1
-                    y_idx = np.digitize(y, y_bins) - 1
-
-                    bin_index = x_idx + y_idx * len(x_bins)
-
-                    # Find max z per bin
-                    if inverse:
-                        sort_idx = np.lexsort((-z, bin_index))  # Sort by bin then z
-                    else:
-                        sort_idx = np.lexsort((z, bin_index))  # Sort by bin then z
-
-                    sorted_bin_idx = bin_index[sort_idx]
-                    unique, first_indices = np.unique(sorted_bin_idx[::-1], return_index=True)
-
-                    # Get max z point per bin
-                    max_indices = sort_idx[::-1][first_indices]
-                    max_points = points[max_indices]
+                    # Bins are evenly spaced from the minimum coordinates
+                    x_idx = ((x - x.min()) / bin_size).astype(np.int64)
+                    y_idx = ((y - y.min()) / bin_size).astype(np.int64)
+                    nx = x_idx.max() + 1
+
+                    bin_index = x_idx + y_idx * nx
+                    num_bins = nx * (y_idx.max() + 1)
+                    if num_bins > 10*len(points):
+                        # sparse bins: relabel to a compact range first
+                        (_, bin_index) = np.unique(bin_index, 
+                            return_inverse=True)
+                        num_bins = bin_index.max() + 1
+
+                    # Find max z per bin (min z if inverse) with a scatter
+                    key = -z if inverse else z
+                    bin_max = np.full(num_bins, -np.inf)
+                    np.maximum.at(bin_max, bin_index, key)
+
+                    # Pick one point per bin reaching the maximum; with 
+                    # duplicate indices the last assignment wins
+                    is_max = np.flatnonzero(key == bin_max[bin_index])
+                    max_indices = np.full(num_bins, -1)
+                    max_indices[bin_index[is_max]] = is_max
+                    max_points = points[max_indices[max_indices >= 0]]
 
                     return max_points
                 pc1 = max_height_per_bin(overlapping_X , grid_res*MAXHEIGHTCOLLISION, inverse=True)
@@ -502,12 +889,18 @@ class Aggregate(object):
         second longest along the y-axis, and the shortest along the z-axis.
         """
 
-        # get and normalize principal axes
-        PA = self.principal_axes()
-        PA /= np.sqrt((PA**2).sum(0))
-        
-        # project to principal axes
-        self.X = np.dot(self.X,PA)
+        # the eigenvectors are already normalized
+        (PA, l) = self._principal_axes_eig()
+
+        # project to principal axes, i.e. X.dot(PA) on the (3,N) buffer
+        n = self._n
+        X_buf = np.empty_like(self._X_buf)
+        np.matmul(PA.T.astype(np.float32), self._X_buf[:,:n], 
+            out=X_buf[:,:n])
+        self._X_buf = X_buf
+        self._update_views()
+        self._XtX = PA.T.dot(self._XtX).dot(PA) if self._XtX is not None \
+            else None
         self.update_extent()
          
          
@@ -581,23 +974,36 @@ class Aggregate(object):
         # location and move them around
         N = Xc.shape[0]
 
-        sort_ind = np.lexsort((Xc[:,2],Xc[:,1],Xc[:,0]))
-        Xc = Xc[sort_ind,:]
-        overlap = abs(np.diff(Xc,axis=0)).sum(1) == 0
-        overlap = np.hstack((overlap, False))
-
-        Xc_overlap = Xc[overlap,:].copy()
-        Xc = Xc[~overlap,:]
+        # pack the coordinates into int64 keys that sort in the same 
+        # order as the rows
+        margin = int(np.ceil(N**(1./3)))+1 # room to relocate elements
+        offset = Xc.min(0)-margin
+        if (Xc.max(0)-offset+margin).max() >= 2**GRID_KEY_BITS:
+            raise ValueError("Aggregate too large to grid at this resolution.")
+        keys = pack_grid_keys(Xc, offset)
+
+        keys.sort()
+        overlap = np.hstack((keys[1:] == keys[:-1], False))
+        keys_overlap = keys[overlap]
+        keys = keys[~overlap]
+        Xc_overlap = unpack_grid_keys(keys_overlap, offset)
         np.random.shuffle(Xc_overlap)
 
+        inserted = set()
         for i in xrange(Xc_overlap.shape[0]):
             Xm = Xc_overlap[i,:]
             for dX in neighbors_by_distance():
-                X = Xm+dX
-                if not row_is_in_sorted_array(X, Xc):
-                    Xc = insert_missing_row_in_sorted_array(X, Xc)
+                k = int(pack_grid_keys(Xm+dX, offset))
+                j = keys.searchsorted(k)
+                if ((j == len(keys)) or (keys[j] != k)) and \
+                    (k not in inserted):
+                    inserted.add(k)
                     break
 
+        keys = np.sort(np.concatenate((keys, 
+            np.fromiter(inserted, dtype=np.int64, count=len(inserted)))))
+        Xc = unpack_grid_keys(keys, offset)
+
         return Xc
 
 
@@ -617,9 +1023,36 @@ class Aggregate(object):
                 after you're done.
         """
 
-        self.X = np.vstack((self.X, added_elements))
-        self.ident = np.hstack((self.ident, 
-            np.full(added_elements.shape[0], ident, dtype=np.int32)))
+        added_elements = np.asarray(added_elements)
+        extent_current = self._extent_current and len(added_elements) and \
+            len(self._x)
+        if extent_current:
+            # extend the extent with the added elements only
+            extent = [[min(e[0], a.min()), max(e[1], a.max())] for (e, a) in 
+                zip(self.extent, added_elements.astype(np.float32).T)]
+
+        # append to the buffers, growing them geometrically when needed
+        n = self._n
+        n_new = n + added_elements.shape[0]
+        if n_new > self._X_buf.shape[1]:
+            capacity = max(2*self._X_buf.shape[1], n_new)
+            X_buf = np.empty((3,capacity), dtype=np.float32)
+            X_buf[:,:n] = self._X_buf[:,:n]
+            self._X_buf = X_buf
+            ident_buf = np.empty(capacity, dtype=np.int32)
+            ident_buf[:n] = self._ident_buf[:n]
+            self._ident_buf = ident_buf
+        self._X_buf[:,n:n_new] = added_elements.T
+        self._ident_buf[n:n_new] = ident
+        if self._XtX is not None:
+            A = self._X_buf[:,n:n_new].astype(np.float64)
+            self._XtX = self._XtX + A.dot(A.T)
+        self._n = n_new
+        self._update_views()
+        self._extent_current = False
+        if extent_current:
+            self.extent = extent
+            self._extent_current = True
         if update:
             self.update_coordinates()
 
@@ -635,13 +1068,27 @@ class Aggregate(object):
             update: See the update keyword argument in add_elements.
         """
 
-        keep = np.ones(self.X.shape[0], dtype=bool)
-        for re in removed_elements:
-            dist_sqr = ((self.X-re)**2).sum(1)
-            min_dist = dist_sqr.argmin()
-            keep[dist_sqr < (self.grid_res**2 * tolerance)] = False
+        X = self.X
+        keep = np.ones(X.shape[0], dtype=bool)
+        removed_elements = np.asarray(removed_elements).reshape(-1,3)
+        dist_sqr_limit = self.grid_res**2 * tolerance
+        if len(removed_elements) < self.KDTREE_MIN_REMOVED:
+            # building the tree costs more than a few sweeps over X
+            for re in removed_elements:
+                keep[((X-re)**2).sum(1) < dist_sqr_limit] = False
+        elif len(keep):
+            tree = cKDTree(X)
+            near = tree.query_ball_point(removed_elements, 
+                r=np.sqrt(dist_sqr_limit))
+            # query_ball_point includes the boundary, so recheck the
+            # candidates with the same strict test as above
+            ind = np.fromiter(chain.from_iterable(near), dtype=np.intp)
+            ind_re = np.repeat(np.arange(len(near)), [len(n) for n in near])
+            dist_sqr = ((X[ind]-removed_elements[ind_re])**2).sum(1)
+            keep[ind[dist_sqr < dist_sqr_limit]] = False
+        ident = self.ident[keep]
         self.X = self.X[keep,:]
-        self.ident = self.ident[keep]
+        self.ident = ident
         if update:
             self.update_coordinates()
 
@@ -649,57 +1096,111 @@ class Aggregate(object):
     def update_coordinates(self):
         """Recenter the aggregate and update the particle extent.
         """
-        self.X -= self.X.mean(0)
-        self.update_extent()
+        extent_current = self._extent_current
+        mean = np.zeros(3)
+        for (i, x) in enumerate((self._x, self._y, self._z)):
+            m = x.mean()
+            x -= m
+            mean[i] = m
+            if extent_current:
+                # shift the known extent rather than recomputing it
+                self.extent[i] = [self.extent[i][0]-m, self.extent[i][1]-m]
+        if self._XtX is not None:
+            self._XtX = self._XtX - self._n*np.outer(mean, mean)
+        self._X = None
+        self._pa = None
+        if not extent_current:
+            self.update_extent()
 
 
-def spheres_overlap(X0, X1, r_sqr):
-    return (X1[0]-X0[0])**2 + (X1[1]-X0[1])**2 + \
-        (X1[2]-X0[2])**2 < r_sqr
+# no fastmath here: contracted arithmetic moves the attachment sites and
+# makes the result differ from the pure Python fallback
+@njit(cache=True)
+def _find_site(ox, oy, oz, xs, ys, grid_res, grid_res_sqr, pen_depth):
+    """Search for a rime attachment site along a vertical line.
 
+    Only the elements below z_min+pen_depth+grid_res (and the lowest one
+    above that) can take part in the search, so just those are sorted.
 
-def compare_row(x,y):
-    if x[0] > y[0]:
-        return 1
-    elif x[0] < y[0]:
-        return -1
-    elif len(x)>1:
-        return compare_row(x[1:],y[1:])
-    else:
-        return 0
-
-
-def row_is_in_sorted_array(r, x):
-    i0 = 0
-    i1 = x.shape[0]
-    while (i1-i0)>1:
-        i = (i0+i1)//2
-        c = compare_row(r,x[i,:])
-        if c == 0:
-            return True
-        elif c == 1:
-            i0=i
-        else:
-            i1=i
-    return not bool(compare_row(r,x[i0,:]))
-
-
-def insert_missing_row_in_sorted_array(r, x):
-    i0 = 0
-    i1 = x.shape[0]
-    while (i1-i0)>1:
-        i = (i0+i1)//2
-        c = compare_row(r,x[i,:])
-        if c == 1:
-            i0=i
-        else:
-            i1=i
-    if i1 > 1:
-        insert_ind = i1
-    else:
-        insert_ind = 1 if compare_row(r,x[i0,:])==1 else 0
-    
-    return np.vstack((x[:insert_ind,:], r.reshape((1,3)), x[insert_ind:,:]))
+    Args:
+        ox, oy, oz: Contiguous float64 arrays with the x, y and z 
+            coordinates of the elements within grid_res of (xs,ys) in the 
+            (x,y) plane, in any order.
+        xs, ys: The (x,y) coordinates of the rime particle.
+        grid_res: The size of each element.
+        grid_res_sqr: grid_res**2.
+        pen_depth: The penetration depth.
+
+    Returns:
+        A (found, zc) tuple; zc is the z coordinate of the site if found.
+    """
+    in_window = oz < oz.min()+pen_depth+grid_res
+    ind = np.nonzero(in_window)[0]
+    ind = ind[np.argsort(oz[ind])]
+    ind_above = np.nonzero(~in_window)[0]
+    if ind_above.size:
+        ind = np.append(ind, ind_above[np.argmin(oz[ind_above])])
+    (ox, oy, oz) = (ox[ind], oy[ind], oz[ind])
+    last_ind = np.searchsorted(oz, oz[0]+pen_depth)
+
+    # the candidate sites are above/below the elements that are within
+    # grid_res in the (x,y) plane
+    d_sqr = (ox[:last_ind]-xs)**2 + (oy[:last_ind]-ys)**2
+    valid = np.nonzero(d_sqr < grid_res_sqr)[0]
+    dz_valid = np.sqrt(grid_res_sqr - d_sqr[valid])
+
+    for m in range(valid.size-1, -1, -1):
+        i = valid[m]
+        dz = dz_valid[m]
+        z_lower = oz[i] - dz
+        for k in range(2):
+            zc = oz[i] + dz if k == 0 else z_lower
+            if (i == 0) and (zc == z_lower):
+                # automatically attach at the last site
+                return (True, zc)
+
+            j0 = np.searchsorted(oz, zc-grid_res)
+            j1 = np.searchsorted(oz, zc+grid_res)
+
+            # search through possible overlapping spheres
+            overlap = False
+            for j in range(j0, j1):
+                if j == i:
+                    continue
+                dx = ox[j]-xs
+                dy = oy[j]-ys
+                dzj = oz[j]-zc
+                if dx*dx + dy*dy + dzj*dzj < grid_res_sqr:
+                    overlap = True
+                    break
+
+            if not overlap:
+                return (True, zc)
+
+    return (False, 0.0)
+
+
+GRID_KEY_BITS = 21
+
+
+def pack_grid_keys(Xc, offset):
+    """Pack integer (x,y,z) coordinates into int64 keys.
+
+    The keys sort in the same order as the coordinate rows sorted
+    lexicographically. Each coordinate minus offset must fit in 
+    GRID_KEY_BITS bits.
+    """
+    Xc = np.asarray(Xc, dtype=np.int64) - offset
+    return (Xc[...,0] << (2*GRID_KEY_BITS)) | (Xc[...,1] << GRID_KEY_BITS) | \
+        Xc[...,2]
+
+
+def unpack_grid_keys(keys, offset):
+    """Inverse of pack_grid_keys."""
+    mask = (1 << GRID_KEY_BITS) - 1
+    Xc = np.column_stack((keys >> (2*GRID_KEY_BITS), 
+        (keys >> GRID_KEY_BITS) & mask, keys & mask))
+    return (Xc + offset).astype(int)
 
 
 def outer_layer_of_cube(cube_rad):
@@ -735,6 +1236,7 @@ class RimedAggregate(Aggregate):
     """
 
     RIME_IDENT = -1
+    RIME_INDEX_BATCH = 256
 
     def add_rime_particles(self, N=1, pen_depth=120e-6, compact_dist=0.):
         """Add rime particles to the aggregate.
@@ -757,12 +1259,21 @@ class RimedAggregate(Aggregate):
         use_indexing = (N > 1)
 
         if use_indexing:
+            # scratch buffer for the index lookups, large enough to hold 
+            # all elements including the added ones
+            near_buf = np.empty((self.X.shape[0]+N, 3))
             elem_index = Index2D(elem_size=grid_res)            
             elem_index.insert(self.X[:,:2],self.X)
             def find_overlapping(x,y,dist_mul=1):
-                p_near = np.array(list(elem_index.items_near((x,y), grid_res*dist_mul)))
+                n = elem_index.items_near_into((x,y), near_buf, 
+                    grid_res*dist_mul)
+                # the added particles not yet inserted in the index
+                n_pending = particle_num-n_indexed
+                near_buf[n:n+n_pending] = \
+                    added_particles[n_indexed:particle_num]
+                p_near = near_buf[:n+n_pending]
                 if not p_near.shape[0]:
-                    return p_near
+                    return p_near.copy()
                 p_filter = ((p_near[:,:2]-[x,y])**2).sum(1) < grid_res_sqr*dist_mul**2
                 return p_near[p_filter,:]
         else:
@@ -776,9 +1287,11 @@ class RimedAggregate(Aggregate):
                 elem_index_3d = Index3D(elem_size=grid_res)            
                 elem_index_3d.insert(self.X)
                 def find_overlapping_3d(x,y,z,dist_mul=1):
-                    p_near = np.array(list(elem_index_3d.items_near((x,y,z), grid_res*dist_mul)))
+                    n = elem_index_3d.items_near_into((x,y,z), near_buf, 
+                        grid_res*dist_mul)
+                    p_near = near_buf[:n]
                     if not p_near.shape[0]:
-                        return p_near
+                        return p_near.copy()
                     p_filter = ((p_near-[x,y,z])**2).sum(1) < grid_res_sqr*dist_mul**2
                     return p_near[p_filter,:]
             else:
@@ -788,6 +1301,7 @@ class RimedAggregate(Aggregate):
                     return self.X[X_filter,:]
 
         added_particles = np.empty((N, 3))
+        n_indexed = 0
 
         for particle_num in xrange(N):
             site_found = False
@@ -795,75 +1309,40 @@ class RimedAggregate(Aggregate):
                 xs = x0+np.random.rand()*(x1-x0)
                 ys = y0+np.random.rand()*(y1-y0)
 
-                overlapping_range = [xs-grid_res, xs+grid_res,
-                     ys-grid_res, ys+grid_res]
-
                 overlapping_X = find_overlapping(xs, ys)
                 if not overlapping_X.shape[0]:
                     continue                  
                 
-                X_order = overlapping_X[:,2].argsort()
-                overlapping_X = overlapping_X[X_order,:]            
-                last_ind = bisect_left(overlapping_X[:,2], 
-                    overlapping_X[0,2]+pen_depth)
-                last_search_ind = bisect_left(overlapping_X[:,2], 
-                    overlapping_X[0,2]+pen_depth+grid_res)
-                overlapping_X = overlapping_X[:last_search_ind+1,:]
-                overlapping_z = overlapping_X[:,2]
-
-                for i in xrange(last_ind-1, -1, -1):
-                    d_sqr = (overlapping_X[i,0]-xs)**2 + (overlapping_X[i,1]-ys)**2
-                    dz = math.sqrt(grid_res_sqr - d_sqr)
-                    z_upper = overlapping_X[i,2] + dz
-                    z_lower = overlapping_X[i,2] - dz                    
-                    
-                    for zc in [z_upper, z_lower]:
-                        overlap = False
-                        if (i==0) and (zc==z_lower):
-                            break # automatically attach at the last site
-
-                        j0 = bisect_left(overlapping_z, zc-grid_res)
-                        j1 = bisect_left(overlapping_z, zc+grid_res)
-                        
-                        #search through possible overlapping spheres
-                        for j in xrange(j0, j1):
-                            if j == i:
-                                continue
-                            elif spheres_overlap(overlapping_X[j,:], (xs,ys,zc), 
-                                grid_res_sqr):
-                                # there is an overlapping sphere -> site unsuitable
-                                overlap = True
-                                break 
-
-                        if not overlap:
-                            break
-
-                    if not overlap:
-                        # this means we found a suitable site, so add the particle
-
-                        # run the compacting first
-                        if compact_dist > 0:
-                            # locate nearby particles to use for the compacting
-                            X_near = find_overlapping_3d(xs, ys, zc, dist_mul=2)
-                            if X_near.size > 0:
-                                X = np.array([xs, ys, zc])
-                                r_sqr = ((X_near-X)**2).sum(axis=1)
-                                X_near = X_near[r_sqr<(2*self.grid_res)**2,:]
-                                (xs, ys, zc) = self.compact_rime(X, X_near, 
-                                    max_dist=compact_dist)
-
-                        added_particles[particle_num,:] = [xs, ys, zc]
-                        site_found = True
-                        self.extent[0][0] = min(self.extent[0][0], xs)
-                        self.extent[0][1] = max(self.extent[0][1], xs)
-                        self.extent[1][0] = min(self.extent[1][0], ys)
-                        self.extent[1][1] = max(self.extent[1][1], ys)
-                        self.extent[2][0] = min(self.extent[2][0], zc)
-                        self.extent[2][1] = max(self.extent[2][1], zc)
-                        if use_indexing:
-                            elem_index.insert([[xs, ys]], [[xs, ys, zc]])
-                        break
-
+                (ox, oy, oz) = np.ascontiguousarray(overlapping_X.T,
+                    dtype=np.float64)
+                (site_found, zc) = _find_site(ox, oy, oz, xs, ys,
+                    grid_res, grid_res_sqr, pen_depth)
+                if not site_found:
+                    continue
+
+                # we found a suitable site, so add the particle;
+                # run the compacting first
+                if compact_dist > 0:
+                    # locate nearby particles to use for the compacting;
+                    # these are already filtered to within 2*grid_res
+                    X_near = find_overlapping_3d(xs, ys, zc, dist_mul=2)
+                    if X_near.shape[0]:
+                        (xs, ys, zc) = self.compact_rime(
+                            np.array([xs, ys, zc]), X_near, 
+                            max_dist=compact_dist)
+
+                added_particles[particle_num,0] = xs
+                added_particles[particle_num,1] = ys
+                added_particles[particle_num,2] = zc
+                if use_indexing and \
+                    (particle_num+1-n_indexed >= self.RIME_INDEX_BATCH):
+                    # insert the added particles in batches; until then
+                    # find_overlapping scans them directly
+                    X_ins = added_particles[n_indexed:particle_num+1]
+                    elem_index.insert(X_ins[:,:2], X_ins)
+                    n_indexed = particle_num+1
+
+        # this also extends the extent with the added particles
         self.add_elements(added_particles, ident=self.RIME_IDENT)
 
 
@@ -873,39 +1352,37 @@ class RimedAggregate(Aggregate):
         if max_dist <= 0.:
             return X
 
+        grid_res = self.grid_res
+        grid_res_sqr = grid_res**2
         X_old = X.copy()
-        max_dist_sqr = (max_dist*self.grid_res)**2
-        min_move_sqr = (min_move*self.grid_res)**2
+        max_dist_sqr = (max_dist*grid_res)**2
+        min_move_sqr = (min_move*grid_res)**2
         for it in xrange(max_iters):
             dX = X_near-X
             r_sqr = (dX**2).sum(axis=1)
-            r_sqr_norm = r_sqr / self.grid_res**2
-            nearest_ind = r_sqr.argsort()
-            F = np.zeros(3)
-            for i in nearest_ind:
-                Fi = dX[i,:]/(np.sqrt(r_sqr[i])*r_sqr_norm[i])
-                if r_sqr_norm[i] > 1:
-                    F += Fi
-                elif r_sqr_norm[i] < 0.01: #avoid singularity
-                    pass
-                else:
-                    F -= Fi
+            r_sqr_norm = r_sqr / grid_res_sqr
+            # attract elements further than grid_res, repel the nearer ones
+            # and ignore those that are very close (avoid singularity)
+            active = r_sqr_norm >= 0.01
+            r_sqr_norm = r_sqr_norm[active]
+            w = np.where(r_sqr_norm > 1, 1.0, -1.0) / \
+                (np.sqrt(r_sqr[active])*r_sqr_norm)
+            F = w.dot(dX[active,:])
 
             F *= dr
             # limit abs(F) to at most dr
             F_abs_sqr = (F**2).sum()
             if F_abs_sqr > dr**2:
-                F *= dr/np.sqrt(F_abs_sqr)
-            F *= self.grid_res
+                F *= dr/math.sqrt(F_abs_sqr)
+            F *= grid_res
 
-            X_last = X.copy()
             X += F
             dist_sqr = ((X-X_old)**2).sum()
-            if dist_sqr/self.grid_res**2 > max_dist_sqr:
+            if dist_sqr > max_dist_sqr*grid_res_sqr:
                 # limit distance to at most max_dist
-                X = X_old + (X-X_old)*(max_dist*self.grid_res/np.sqrt(dist_sqr))
+                X = X_old + (X-X_old)*(max_dist*grid_res/math.sqrt(dist_sqr))
                 break
-            if ((X-X_last)**2).sum() < min_move_sqr:
+            if (F**2).sum() < min_move_sqr:
                 break
 
         return X
@@ -923,27 +1400,36 @@ class PseudoAggregate(Aggregate):
         self.sig = sig
         self.generator = generator
 
-        self.X = self.generator.generate().T
-        x = self.X[:,0]+stats.norm.rvs(scale=sig)
-        y = self.X[:,1]+stats.norm.rvs(scale=sig)
-        z = self.X[:,2]+stats.norm.rvs(scale=sig)
-        self.extent = [[x.min(), x.max()], [y.min(), y.max()], [z.min(), z.max()]]
+        # each crystal is displaced as a whole by a normally distributed
+        # offset
+        X = self.generator.generate().T
+        self.X = X + self._random_generator().normal(scale=sig, size=3)
         self.ident = np.full(self.X.shape[0], ident, dtype=np.int32)
+        self.update_extent()
         self.monomer_number = 1
         self.id_tree = ident
          
                   
     def add_particle(self, particle=None, required=False, add_N_monomers=None, add_id_branch=None):
-        if particle == None:
+        """Add a particle at a random offset from the origin.
+
+        The elements are appended to the geometrically grown coordinate
+        buffer (see add_elements), so adding N particles costs O(N) in 
+        total rather than O(N^2).
+
+        Args:
+            particle: The (N,3) array of particle coordinates. If None, a 
+                new crystal is made with the generator.
+            required: Ignored; accepted for compatibility with 
+                Aggregate.add_particle.
+            add_N_monomers: The number of monomers in the particle.
+            add_id_branch: The aggregation tree of the particle.
+        """
+        if particle is None:
             particle = self.generator.generate().T
             add_N_monomers = 1
-        x = particle[:,0]+stats.norm.rvs(scale=self.sig)
-        y = particle[:,1]+stats.norm.rvs(scale=self.sig)
-        z = particle[:,2]+stats.norm.rvs(scale=self.sig)
-        self.X = numpy.vstack((self.X, numpy.vstack((x,y,z)).T)) 
-        x = self.X[:,0]
-        y = self.X[:,1]
-        z = self.X[:,2]
-        self.extent = [[x.min(), x.max()], [y.min(), y.max()], [z.min(), z.max()]]
+        offset = self._random_generator().normal(scale=self.sig, size=3)
+        # extends the extent with the new elements only
+        self.add_elements(particle+offset, update=False)
         self.monomer_number += add_N_monomers
         self.id_tree = [self.id_tree, add_id_branch]
@@ -18,12 +18,21 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
+try:
+  import cPickle as pickle
+except:
+  import pickle
+import sys
+
 import numpy as np
 from numpy import array, sign
 from scipy.optimize import brentq
 from . import dendrite
 
 
+_dendrite_grid = None
+
 class Crystal(object):
     """Base class for all Crystal objects.
 
@@ -178,6 +187,24 @@ class Column(Plate):
         super(Column, self).__init__(D_plate_eq)
 
 
+def load_dendrite_grid():
+    """Load the pregenerated dendrite shape distributed with the package.
+
+    The file is only read on the first call; later calls return the same
+    array, which should therefore not be modified.
+
+    Returns:
+        The hexagonal grid to be passed to Dendrite as hex_grid.
+    """
+    global _dendrite_grid
+    if _dendrite_grid is None:
+        current_dir = os.path.dirname(os.path.realpath(__file__))
+        with open(current_dir+"/dendrite_grid.dat", 'rb') as f:
+            kwargs = {"encoding": "latin1"} if sys.version_info[0] >= 3 else {}
+            _dendrite_grid = pickle.load(f, **kwargs)
+    return _dendrite_grid
+
+
 class Dendrite(Plate):
     """Dendrite crystal geometry.
 
@@ -45,6 +45,7 @@ class Index2D(object):
     def __init__(self, elem_size=1):
         self._elem_size = float(elem_size)
         self._grid = {} # this holds the index
+        self._cell_arrays = {} # stacked cell items for items_near_into
         
         
     def insert(self, coordinates, objects=None):
@@ -66,6 +67,7 @@ class Index2D(object):
                 self._grid[(x_i,y_i)].append(((x,y),obj))
             except KeyError:
                 self._grid[(x_i,y_i)] = [((x,y),obj)]
+            self._cell_arrays.pop((x_i,y_i), None)
                 
     
     def _items_in_cell(self, x_i, y_i):
@@ -105,6 +107,52 @@ class Index2D(object):
         return chain(*items)
 
 
+    def items_near_into(self, p, out, search_rad=1):
+        """Copy all indexed items near a point into a preallocated array.
+
+        Like items_near, but the items are written as rows of out instead
+        of being returned as an iterator. This avoids creating new arrays
+        when the same lookup is repeated for many points.
+
+        Args:
+            p: The reference point.
+            out: The output array. Must have enough rows to hold all the
+                items found.
+            search_rad: The search radius.
+
+        Returns:
+            The number of items written to out.
+        """
+
+        p = np.array(p)/self._elem_size
+        search_rad = search_rad/self._elem_size
+        (px, py) = p
+
+        cell_x = xrange(int(px-search_rad), int(px+search_rad)+1)
+        cell_y = xrange(int(py-search_rad), int(py+search_rad)+1)
+
+        n = 0
+        for (x_i, y_i) in product(cell_x, cell_y):
+            items = self._cell_array(x_i, y_i)
+            if items is not None:
+                out[n:n+len(items)] = items
+                n += len(items)
+
+        return n
+
+
+    def _cell_array(self, x_i, y_i):
+        # the objects in a cell stacked into an array; cached until the
+        # next insert into that cell
+        try:
+            return self._cell_arrays[(x_i,y_i)]
+        except KeyError:
+            items = self._items_in_cell(x_i, y_i)
+            arr = np.array([item[1] for item in items]) if items else None
+            self._cell_arrays[(x_i,y_i)] = arr
+            return arr
+
+
 class Index3D(object):
     """Index 3D coordinates.
 
@@ -118,6 +166,7 @@ class Index3D(object):
     def __init__(self, elem_size=1):
         self._elem_size = float(elem_size)
         self._grid = {}
+        self._cell_arrays = {} # stacked cell items for items_near_into
 
 
     def size(self):
@@ -144,6 +193,7 @@ class Index3D(object):
                 self._grid[(x_i,y_i,z_i)].append((x,y,z))
             except KeyError:
                 self._grid[(x_i,y_i,z_i)] = [(x,y,z)]
+            self._cell_arrays.pop((x_i,y_i,z_i), None)
 
 
     def remove(self, coordinates):
@@ -164,6 +214,7 @@ class Index3D(object):
                 print(self._grid[(x_i,y_i,z_i)])
                 raise 
             self._grid[(x_i,y_i,z_i)].pop(ind)
+            self._cell_arrays.pop((x_i,y_i,z_i), None)
             if len(self._grid[(x_i,y_i,z_i)]) == 0:
                 del self._grid[(x_i,y_i,z_i)]
 
@@ -201,3 +252,50 @@ class Index3D(object):
             items.append(self._items_in_cell(x_i, y_i, z_i))
         
         return chain(*items)
+
+
+    def items_near_into(self, p, out, search_rad=1):
+        """Copy all indexed items near a point into a preallocated array.
+
+        Like items_near, but the items are written as rows of out instead
+        of being returned as an iterator. This avoids creating new arrays
+        when the same lookup is repeated for many points.
+
+        Args:
+            p: The reference point.
+            out: The output array. Must have enough rows to hold all the
+                items found.
+            search_rad: The search radius.
+
+        Returns:
+            The number of items written to out.
+        """
+
+        p = np.array(p)/self._elem_size
+        search_rad = search_rad/self._elem_size
+        (px, py, pz) = p
+
+        cell_x = xrange(int(px-search_rad), int(px+search_rad)+1)
+        cell_y = xrange(int(py-search_rad), int(py+search_rad)+1)
+        cell_z = xrange(int(pz-search_rad), int(pz+search_rad)+1)
+
+        n = 0
+        for (x_i, y_i, z_i) in product(cell_x, cell_y, cell_z):
+            items = self._cell_array(x_i, y_i, z_i)
+            if items is not None:
+                out[n:n+len(items)] = items
+                n += len(items)
+
+        return n
+
+
+    def _cell_array(self, x_i, y_i, z_i):
+        # the coordinates in a cell stacked into an array; cached until the
+        # cell is next modified
+        try:
+            return self._cell_arrays[(x_i,y_i,z_i)]
+        except KeyError:
+            items = self._items_in_cell(x_i, y_i, z_i)
+            arr = np.array(items) if items else None
+            self._cell_arrays[(x_i,y_i,z_i)] = arr
+            return arr
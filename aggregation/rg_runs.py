@@ -18,18 +18,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import os
 import sys
-try:
-  import cPickle as pickle
-except:
-  import pickle
 
 from numpy import array, random
 import numpy
 from scipy import stats
 
 from . import aggregate, crystal, rotator, generator
+from .crystal import load_dendrite_grid
 
 
 if sys.version_info[0] >= 3:
@@ -81,14 +77,6 @@ def monodisp_dendrite(N=5,grid=None,align=True):
    return agg[0]
 
 
-def load_dendrite_grid():
-   current_dir = os.path.dirname(os.path.realpath(__file__))
-   with open(current_dir+"/dendrite_grid.dat", 'rb') as f:
-       kwargs = {"encoding": "latin1"} if sys.version_info[0] >= 3 else {}
-       grid = pickle.load(f, **kwargs)
-   return grid
-
-
 def gen_monodisp(N_range=(1,101)):
    grid = load_dendrite_grid()
    for N in xrange(*N_range):
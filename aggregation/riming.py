@@ -19,12 +19,7 @@ SOFTWARE.
 """
 
 import argparse
-try:
-  import cPickle as pickle
-except:
-  import pickle
 import gzip
-import os
 import sys
 
 from numpy import random
@@ -215,8 +210,8 @@ def generate_rimed_aggregate_iter(monomer_generator, N=5, align=True,
         r = np.array([((a.extent[0][1]-a.extent[0][0])+
             (a.extent[1][1]-a.extent[1][0]))/4.0 for a in agg])
         m_r = np.sqrt(np.array([a.X.shape[0] for a in agg])/r)
-        r_mat = (np.tile(r,(len(agg),1)).T+r)**2                
-        mr_mat = abs(np.tile(m_r,(len(agg),1)).T - m_r)
+        r_mat = (r[:,None]+r)**2
+        mr_mat = abs(m_r[:,None]-m_r)
         p_mat = r_mat * mr_mat
         p_mat /= p_mat.max()
         collision = False
@@ -340,11 +335,7 @@ def gen_monomer(psd="monodisperse", size=1e-3, shape=3.0, min_size=0.1e-3,
         
     def make_cry(D):
         if mono_type=="dendrite":
-            current_dir = os.path.dirname(os.path.realpath(__file__))
-            with open(current_dir+"/dendrite_grid.dat", 'rb') as f:
-                kwargs = {"encoding": "latin1"} if sys.version_info[0] >= 3 else {}
-                grid = pickle.load(f, **kwargs)
-            cry = crystal.Dendrite(D, hex_grid=grid)
+            cry = crystal.Dendrite(D, hex_grid=crystal.load_dendrite_grid())
         elif mono_type=="plate":
             cry = crystal.Plate(D)            
         elif mono_type=="needle":
@@ -19,12 +19,8 @@ SOFTWARE.
 """
 
 import argparse
-try:
-  import cPickle as pickle
-except:
-  import pickle
 import json
-import os
+import multiprocessing
 import sys
 
 from numpy import array, random
@@ -38,7 +34,10 @@ if sys.version_info[0] >= 3:
     xrange = range
 
 
-def generate_aggregate(monomer_generator,N=5,align=True):
+def generate_aggregate(monomer_generator,N=5,align=True,seed=None):
+
+    if seed is not None:
+        random.seed(seed)
 
     align_rot = rotator.PartialAligningRotator(exp_sig_deg=40)
     uniform_rot = rotator.UniformRotator()
@@ -48,8 +47,8 @@ def generate_aggregate(monomer_generator,N=5,align=True):
     while len(agg) > 1:
         r = array([((a.extent[0][1]-a.extent[0][0])+(a.extent[1][1]-a.extent[1][0]))/4.0 for a in agg])
         m_r = np.sqrt(array([a.X.shape[0] for a in agg])/r)
-        r_mat = (np.tile(r,(len(agg),1)).T+r)**2
-        mr_mat = abs(np.tile(m_r,(len(agg),1)).T - m_r)
+        r_mat = (r[:,None]+r)**2
+        mr_mat = abs(m_r[:,None]-m_r)
         p_mat = r_mat * mr_mat
         p_mat /= p_mat.max()
         collision = False
@@ -80,16 +79,53 @@ def generate_aggregate(monomer_generator,N=5,align=True):
     return agg[0]
 
 
+def _generate_aggregate_task(task):
+    (monomer_kwargs, N, align, seed) = task
+    return generate_aggregate(gen_monomer(**monomer_kwargs), N=N, 
+        align=align, seed=seed)
+
+
+def generate_aggregate_ensemble(monomer_kwargs, N_list, align=True, 
+    seed=None, processes=None):
+    """Generate independent aggregates in parallel processes.
+
+    Args:
+        monomer_kwargs: Keyword arguments for gen_monomer, used to make the
+            monomer generator in each process.
+        N_list: The number of monomers in each aggregate.
+        align: See generate_aggregate.
+        seed: Random seed used to derive a separate seed for each 
+            aggregate. The results depend only on this, not on the number
+            of processes.
+        processes: Number of worker processes; defaults to the number of
+            CPUs.
+
+    Returns:
+        A list of the aggregates, in the same order as N_list.
+
+    The worker processes are spawned, so a script calling this must guard
+    its main code with "if __name__ == '__main__':".
+    """
+
+    seeds = np.random.default_rng(seed).integers(2**31, size=len(N_list))
+    tasks = [(monomer_kwargs, N, align, int(s)) for (N, s) in 
+        zip(N_list, seeds)]
+    # spawn rather than fork: forking a process that has already started
+    # threads (e.g. a numba or BLAS thread pool) can leave it hanging
+    pool = multiprocessing.get_context("spawn").Pool(processes)
+    try:
+        return list(pool.imap(_generate_aggregate_task, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def gen_monomer(psd="monodisperse", size=1.0, min_size=1e-3, max_size=10,
     mono_type="dendrite", grid_res=0.02e-3, rimed=False):
         
     def make_cry(D):
         if mono_type=="dendrite":
-           current_dir = os.path.dirname(os.path.realpath(__file__))
-           with open(current_dir+"/dendrite_grid.dat", 'rb') as f:
-               kwargs = {"encoding": "latin1"} if sys.version_info[0] >= 3 else {}
-               grid = pickle.load(f, **kwargs)
-           cry = crystal.Dendrite(D, hex_grid=grid)
+           cry = crystal.Dendrite(D, hex_grid=crystal.load_dendrite_grid())
         elif mono_type=="plate":
             cry = crystal.Plate(D)            
         elif mono_type=="needle":
@@ -68,15 +68,22 @@ for i_size,sizem in enumerate(np.logspace(np.log10(50.0),np.log10(2000.0),20)):
             t0 = time.time()
             with open(dir_shape+evol_file,"wb") as f_iter:
                 np.savetxt(f_iter,np.vstack(('mass','area','D_max','vel_HW','vel_KC')).T, fmt='%s')
-                mass = []; area = []; D_max = []; vel_HW = []; vel_KC = [] 
+                # one row per stage: mass, area, D_max, vel_HW, vel_KC;
+                # agg_iter has no length, so grow the array as needed
+                evol = np.empty((64,5)); n_evol = 0
                 for agg in agg_iter:
                     agg = agg[0]
-                    mass.append(rho_i*agg.X.shape[0]*agg.grid_res**3)
-                    area.append(agg.vertical_projected_area())
-                    D_max.append(mcs.minimum_covering_sphere(agg.X)[1]*2)
-                    vel_HW.append(fallvelocity.fall_velocity(agg, method="HW"))
-                    vel_KC.append(fallvelocity.fall_velocity(agg, method="KC"))
-                np.savetxt(f_iter, np.vstack((mass, area, D_max, vel_HW, vel_KC)).T, fmt="%.6e")
+                    if n_evol == evol.shape[0]:
+                        evol = np.concatenate((evol, np.empty_like(evol)))
+                    evol[n_evol] = (rho_i*agg.X.shape[0]*agg.grid_res**3,
+                        agg.vertical_projected_area(),
+                        mcs.minimum_covering_sphere(agg.X)[1]*2,
+                        fallvelocity.fall_velocity(agg, method="HW"),
+                        fallvelocity.fall_velocity(agg, method="KC"))
+                    n_evol += 1
+                evol = evol[:n_evol]
+                np.savetxt(f_iter, evol, fmt="%.6e")
+                (mass, area, D_max, vel_HW, vel_KC) = evol.T
                 f_iter.close()
                     
             print('Nmono',Nmono)